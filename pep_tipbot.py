@@ -1,11 +1,15 @@
 import asyncio
 import logging
 import os
-import random
+import re
 import sqlite3
 import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from decimal import Decimal, ROUND_DOWN, getcontext
 
+import aiosqlite
+import httpx
 import requests
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ChatType
@@ -44,99 +48,229 @@ log = logging.getLogger("pep_tipbot")
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
-# --- Storage (SQLite) --------------------------------------------------------
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-conn.execute("""
+# Serializes all writes at the application layer so concurrent handlers and
+# the scanner never pile up on SQLite's internal writer lock (SQLITE_BUSY).
+# Reads stay lock-free: WAL lets them run alongside a writer.
+WRITE_LOCK = asyncio.Lock()
+
+# Caps in-flight notifications below Telegram's ~30 msg/s limit.
+NOTIFY_SEM = asyncio.Semaphore(25)
+
+# --- Storage (SQLite via aiosqlite) ------------------------------------------
+# One long-lived connection, opened in main() once the loop is running.
+# aiosqlite runs statements on its own dedicated thread, so handlers await
+# them directly with no per-call asyncio.to_thread hop.
+conn: aiosqlite.Connection | None = None
+
+
+@asynccontextmanager
+async def tx(immediate: bool = False):
+    # Commit-or-rollback scope replacing sqlite3's ``with conn:`` idiom
+    # (on an aiosqlite connection, ``async with conn`` would close it).
+    if immediate:
+        await conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except Exception:
+        await conn.rollback()
+        raise
+    else:
+        await conn.commit()
+
+
+async def init_db():
+    # WAL keeps readers (scanner) unblocked while handlers write, and
+    # synchronous=NORMAL drops the per-commit fsync to a WAL append.
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA cache_size=-64000")
+    await conn.execute("PRAGMA mmap_size=268435456")
+    await conn.execute("PRAGMA wal_autocheckpoint=1000")
+    # Ledger amounts are stored as integer satoshis (1 coin = 1e8 sat):
+    # varint rows instead of ~20-byte TEXT, CPU-int comparisons instead of
+    # Decimal, and `balance_sat = balance_sat + ?` works natively in SQL.
+    await conn.execute("""
 CREATE TABLE IF NOT EXISTS users (
   tg_id INTEGER PRIMARY KEY,
   username TEXT,
   deposit_address TEXT,
-  credited_total TEXT DEFAULT '0',
-  balance TEXT DEFAULT '0',
+  credited_sat INTEGER DEFAULT 0,
+  balance_sat INTEGER DEFAULT 0,
   last_faucet_ts INTEGER DEFAULT 0,
   last_active_ts INTEGER DEFAULT 0,
   created_ts INTEGER DEFAULT 0
 );
 """)
-conn.execute("""
+    await conn.execute("""
 CREATE TABLE IF NOT EXISTS transfers (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   kind TEXT, -- deposit|tip|withdraw|faucet
   from_tg INTEGER,
   to_tg INTEGER,
-  amount TEXT,
+  amount_sat INTEGER,
   txid TEXT,
   ts INTEGER
 );
 """)
-conn.commit()
+    await conn.execute("""
+CREATE TABLE IF NOT EXISTS kv (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+""")
+    await conn.execute("""
+CREATE TABLE IF NOT EXISTS seen_txs (
+  txid TEXT,
+  address TEXT,
+  PRIMARY KEY (txid, address)
+);
+""")
+    # B-tree range scan for the activity cutoff and an indexed case-insensitive
+    # username lookup, instead of full table scans.
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active_ts)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_transfers_ts ON transfers(ts)")
+    await conn.commit()
+    await _migrate_amounts_to_sat()
+
+
+async def _migrate_amounts_to_sat():
+    # One-shot migration for databases created before the satoshi columns.
+    cur = await conn.execute("PRAGMA table_info(users)")
+    ucols = {row[1] for row in await cur.fetchall()}
+    if "balance" in ucols and "balance_sat" not in ucols:
+        await conn.execute("ALTER TABLE users ADD COLUMN credited_sat INTEGER DEFAULT 0")
+        await conn.execute("ALTER TABLE users ADD COLUMN balance_sat INTEGER DEFAULT 0")
+        await conn.execute("UPDATE users SET "
+                           "credited_sat = CAST(ROUND(CAST(credited_total AS REAL) * 100000000) AS INTEGER), "
+                           "balance_sat = CAST(ROUND(CAST(balance AS REAL) * 100000000) AS INTEGER)")
+    cur = await conn.execute("PRAGMA table_info(transfers)")
+    tcols = {row[1] for row in await cur.fetchall()}
+    if "amount" in tcols and "amount_sat" not in tcols:
+        await conn.execute("ALTER TABLE transfers ADD COLUMN amount_sat INTEGER")
+        await conn.execute("UPDATE transfers SET amount_sat = CAST(ROUND(CAST(amount AS REAL) * 100000000) AS INTEGER)")
+    await conn.commit()
 
 
 def now() -> int:
     return int(time.time())
 
 
-def db_get_user(tg_id: int):
-    cur = conn.execute("SELECT tg_id, username, deposit_address, credited_total, balance, last_faucet_ts, last_active_ts FROM users WHERE tg_id=?",
-                       (tg_id,))
-    row = cur.fetchone()
-    if not row:
-        return None
-    return {
-        "tg_id": row[0], "username": row[1], "deposit_address": row[2],
-        "credited_total": Decimal(row[3]), "balance": Decimal(row[4]),
-        "last_faucet_ts": row[5], "last_active_ts": row[6]
-    }
-
-
-def db_upsert_user(tg_id: int, username: str):
-    u = db_get_user(tg_id)
-    if u:
-        conn.execute("UPDATE users SET username=?, last_active_ts=? WHERE tg_id=?",
-                     (username, now(), tg_id))
-    else:
-        conn.execute("INSERT INTO users(tg_id, username, created_ts, last_active_ts) VALUES(?,?,?,?)",
-                     (tg_id, username, now(), now()))
-    conn.commit()
+SATS_PER_COIN = 100_000_000
+
+
+def to_sat(x: Decimal) -> int:
+    return int((x * SATS_PER_COIN).to_integral_value(rounding=ROUND_DOWN))
+
+
+def from_sat(sat: int) -> Decimal:
+    return Decimal(sat) / SATS_PER_COIN
+
+
+FAUCET_AMOUNT_SAT = to_sat(FAUCET_AMOUNT)
+
+
+async def db_get_user(tg_id: int) -> sqlite3.Row | None:
+    cur = await conn.execute("SELECT tg_id, username, deposit_address, credited_sat, balance_sat, last_faucet_ts, last_active_ts FROM users WHERE tg_id=?",
+                             (tg_id,))
+    return await cur.fetchone()
+
 
+# db_* helpers never commit themselves; callers group them into one
+# transaction per handler (``async with tx():``) so a multi-write command
+# costs a single fsync instead of one per statement.
+async def db_upsert_user(tg_id: int, username: str):
+    # one atomic statement instead of SELECT-then-INSERT/UPDATE; also
+    # bumps last_active_ts, so callers don't need a separate db_set_active
+    ts = now()
+    await conn.execute("""INSERT INTO users(tg_id, username, created_ts, last_active_ts) VALUES(?,?,?,?)
+ON CONFLICT(tg_id) DO UPDATE SET username=excluded.username, last_active_ts=excluded.last_active_ts""",
+                       (tg_id, username, ts, ts))
 
-def db_update_balance(tg_id: int, new_balance: Decimal):
-    conn.execute("UPDATE users SET balance=? WHERE tg_id=?", (str(new_balance), tg_id))
-    conn.commit()
 
+async def db_credit(tg_id: int, delta_sat: int):
+    await conn.execute("UPDATE users SET balance_sat = balance_sat + ? WHERE tg_id=?",
+                       (delta_sat, tg_id))
 
-def db_add_transfer(kind: str, from_tg, to_tg, amount: Decimal, txid: str | None):
-    conn.execute("INSERT INTO transfers(kind, from_tg, to_tg, amount, txid, ts) VALUES(?,?,?,?,?,?)",
-                 (kind, from_tg, to_tg, str(amount), txid, now()))
-    conn.commit()
 
+async def db_debit(tg_id: int, delta_sat: int) -> bool:
+    """Atomically debit `delta_sat`; returns False if the balance is too low.
 
-def db_set_deposit_address(tg_id: int, addr: str):
-    conn.execute("UPDATE users SET deposit_address=? WHERE tg_id=?", (addr, tg_id))
-    conn.commit()
+    The WHERE clause enforces non-negative balances in SQL, replacing the
+    racy read-compare-write the handlers used to do.
+    """
+    cur = await conn.execute("UPDATE users SET balance_sat = balance_sat - ? WHERE tg_id=? AND balance_sat >= ?",
+                             (delta_sat, tg_id, delta_sat))
+    return cur.rowcount == 1
 
 
-def db_set_credited_total(tg_id: int, total: Decimal):
-    conn.execute("UPDATE users SET credited_total=? WHERE tg_id=?", (str(total), tg_id))
-    conn.commit()
+async def db_add_transfer(kind: str, from_tg, to_tg, amount_sat: int, txid: str | None):
+    await conn.execute("INSERT INTO transfers(kind, from_tg, to_tg, amount_sat, txid, ts) VALUES(?,?,?,?,?,?)",
+                       (kind, from_tg, to_tg, amount_sat, txid, now()))
 
 
-def db_set_last_faucet(tg_id: int, ts: int):
-    conn.execute("UPDATE users SET last_faucet_ts=? WHERE tg_id=?", (ts, tg_id))
-    conn.commit()
+async def db_set_deposit_address(tg_id: int, addr: str):
+    await conn.execute("UPDATE users SET deposit_address=? WHERE tg_id=?", (addr, tg_id))
 
 
-def db_set_active(tg_id: int):
-    conn.execute("UPDATE users SET last_active_ts=? WHERE tg_id=?", (now(), tg_id))
-    conn.commit()
+async def db_kv_get(key: str) -> str | None:
+    cur = await conn.execute("SELECT value FROM kv WHERE key=?", (key,))
+    row = await cur.fetchone()
+    return row[0] if row else None
 
 
-def db_get_active_users(chat_member_ids: list[int]) -> list[int]:
+async def db_kv_set(key: str, value: str):
+    await conn.execute("INSERT INTO kv(key, value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                       (key, value))
+
+
+async def db_set_last_faucet(tg_id: int, ts: int):
+    await conn.execute("UPDATE users SET last_faucet_ts=? WHERE tg_id=?", (ts, tg_id))
+
+
+async def db_set_active(tg_id: int):
+    await conn.execute("UPDATE users SET last_active_ts=? WHERE tg_id=?", (now(), tg_id))
+
+
+async def db_register_user(tg_id: int, username: str):
+    async with tx():
+        await db_upsert_user(tg_id, username)
+
+
+async def db_find_by_username(username: str) -> int | None:
+    cur = await conn.execute("SELECT tg_id FROM users WHERE LOWER(username)=? LIMIT 1",
+                             (username.lower(),))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def db_active_ids(cutoff: int) -> list[int]:
+    cur = await conn.execute("SELECT tg_id FROM users WHERE last_active_ts>=?", (cutoff,))
+    return [row[0] for row in await cur.fetchall()]
+
+
+async def db_random_active_id(cutoff: int, exclude_tg: int) -> int | None:
+    # RANDOM() selection happens inside SQLite over the index-narrowed
+    # candidates; no Python-side list of every active user
+    cur = await conn.execute("SELECT tg_id FROM users WHERE last_active_ts>=? AND tg_id<>? ORDER BY RANDOM() LIMIT 1",
+                             (cutoff, exclude_tg))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def db_active_usernames(cutoff: int) -> list[str]:
+    cur = await conn.execute("SELECT username FROM users WHERE last_active_ts>=? ORDER BY last_active_ts DESC",
+                             (cutoff,))
+    return [row[0] for row in await cur.fetchall() if row[0]]
+
+
+async def db_get_active_users(chat_member_ids: list[int]) -> list[int]:
     cutoff = now() - ACTIVE_WINDOW
     qmarks = ",".join("?" for _ in chat_member_ids)
-    cur = conn.execute(f"SELECT tg_id FROM users WHERE last_active_ts>=? AND tg_id IN ({qmarks})",
-                       (cutoff, *chat_member_ids))
-    return [row[0] for row in cur.fetchall()]
+    cur = await conn.execute(f"SELECT tg_id FROM users WHERE last_active_ts>=? AND tg_id IN ({qmarks})",
+                             (cutoff, *chat_member_ids))
+    return [row[0] for row in await cur.fetchall()]
 
 
 # --- RPC ---------------------------------------------------------------------
@@ -146,51 +280,115 @@ class RPC:
         self.user = user
         self.password = password
         self._id = 0
+        # Keep-Alive session: reuse the TCP connection and the prepared
+        # auth header across calls instead of a fresh handshake per RPC
+        self.s = requests.Session()
+        self.s.auth = (user, password)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.s.mount("http://", adapter)
+        self.s.mount("https://", adapter)
+        # Async twin for handlers and the scanner: a node that takes its
+        # full 30s timeout no longer freezes the event loop (and with it
+        # every command) for the duration.
+        self.client = httpx.AsyncClient(auth=(user, password), timeout=30)
 
     def call(self, method: str, params=None):
         if params is None:
             params = []
         self._id += 1
         payload = {"jsonrpc": "1.0", "id": self._id, "method": method, "params": params}
-        r = requests.post(self.url, json=payload, auth=(self.user, self.password), timeout=30)
+        r = self.s.post(self.url, json=payload, timeout=30)
         r.raise_for_status()
         data = r.json()
         if data.get("error"):
             raise RuntimeError(data["error"])
         return data["result"]
 
+    async def acall(self, method: str, params=None):
+        if params is None:
+            params = []
+        self._id += 1
+        payload = {"jsonrpc": "1.0", "id": self._id, "method": method, "params": params}
+        delay = 0.5
+        for attempt in range(3):
+            r = await self.client.post(self.url, json=payload)
+            try:
+                data = r.json()
+            except ValueError:
+                data = None
+            if data and data.get("error"):
+                # RPC-level failure (bitcoind forks relay these over HTTP
+                # 500); deterministic, so retrying would just re-submit it
+                raise RuntimeError(data["error"])
+            if r.status_code >= 500 and attempt < 2:
+                # transient node trouble (warming up, overloaded): back off
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+            r.raise_for_status()
+            if data is None:
+                raise RuntimeError("non-JSON response from node")
+            return data["result"]
+
 
 rpc = RPC(RPC_URL, RPC_USER, RPC_PASSWORD)
 
 
-def get_or_create_deposit_address(tg_id: int) -> str:
-    u = db_get_user(tg_id)
+async def get_or_create_deposit_address(tg_id: int) -> str:
+    u = await db_get_user(tg_id)
     if u and u["deposit_address"]:
         return u["deposit_address"]
     label = f"{WALLET_LABEL_PREFIX}{tg_id}"
-    addr = rpc.call("getnewaddress", [label])
-    db_set_deposit_address(tg_id, addr)
+    addr = await rpc.acall("getnewaddress", [label])
+    async with WRITE_LOCK:
+        async with tx():
+            await db_set_deposit_address(tg_id, addr)
     return addr
 
 
-def query_received_confirmed(addr: str, minconf=MIN_CONF) -> Decimal:
+async def query_received_confirmed(addr: str, minconf=MIN_CONF) -> Decimal:
     # Works on bitcoind/dogecoind forks
-    val = rpc.call("getreceivedbyaddress", [addr, minconf])
+    val = await rpc.acall("getreceivedbyaddress", [addr, minconf])
     return Decimal(str(val))
 
 
-def faucet_address() -> str:
-    return rpc.call("getnewaddress", [FAUCET_LABEL])
+_faucet_addr: str | None = None
+
+
+async def faucet_address() -> str:
+    # cached in memory and the kv table: getnewaddress would mint (and
+    # persist) a fresh wallet address on every /faucetinfo otherwise
+    global _faucet_addr
+    if _faucet_addr:
+        return _faucet_addr
+    addr = await db_kv_get("faucet_address")
+    if not addr:
+        try:
+            addrs = await rpc.acall("getaddressesbylabel", [FAUCET_LABEL])
+        except Exception:
+            addrs = None
+        addr = next(iter(addrs)) if addrs else await rpc.acall("getnewaddress", [FAUCET_LABEL])
+        async with WRITE_LOCK:
+            async with tx():
+                await db_kv_set("faucet_address", addr)
+    _faucet_addr = addr
+    return _faucet_addr
 
 
-def faucet_balance_confirmed(minconf=MIN_CONF) -> Decimal:
+async def faucet_balance_confirmed(minconf=MIN_CONF) -> Decimal:
     # Sum confirmed received to the faucet address label (approximation)
     # If your node supports label balance APIs, replace accordingly.
-    addr = faucet_address()
-    return query_received_confirmed(addr, minconf)
+    addr = await faucet_address()
+    return await query_received_confirmed(addr, minconf)
 
 
 # --- Bot text ----------------------------------------------------------------
+# computed once: /faucet is the highest-volume command and its reply
+# re-derived this on every invocation
+_FAUCET_PERIOD_STR = (f"{FAUCET_INTERVAL//3600} hours"
+                      if FAUCET_INTERVAL >= 3600 and FAUCET_INTERVAL % 3600 == 0
+                      else f"{FAUCET_INTERVAL//60} minutes")
+
 HELP_TEXT = f"""Welcome to the Pepecoin TipBot!
 
 Available commands:
@@ -205,7 +403,7 @@ Available commands:
 /deposit - Get your deposit address
 /withdraw amount address - Withdraw {COIN}
 
-/faucet - Request {FAUCET_AMOUNT} {COIN} per {FAUCET_INTERVAL//3600 if FAUCET_INTERVAL%3600==0 else FAUCET_INTERVAL//60} {'hours' if FAUCET_INTERVAL>=3600 else 'minutes'}
+/faucet - Request {FAUCET_AMOUNT} {COIN} per {_FAUCET_PERIOD_STR}
 /faucetinfo - Show faucet deposit address and balance
 /active - Show a list of users active in the last 30 minutes
 /help - Show help message
@@ -218,18 +416,62 @@ Notes:
 """
 
 
+def fmt_sat(sat: int) -> str:
+    # pure integer divmod; no Decimal quantize or repeated str() on the
+    # reply-building hot path
+    whole, frac = divmod(sat, SATS_PER_COIN)
+    if not frac:
+        return str(whole)
+    return f"{whole}.{frac:08d}".rstrip("0")
+
+
 def fmt_amt(x: Decimal) -> str:
-    q = Decimal("0.00000001")  # 8 dp
-    return str(x.quantize(q, rounding=ROUND_DOWN)).rstrip("0").rstrip(".") if "." in str(x) else str(x)
+    # thin Decimal adapter for the few non-satoshi callers
+    return fmt_sat(to_sat(x))
+
+
+# static part of the /faucet success reply, built once
+_FAUCET_REPLY_PREFIX = (f"You received {fmt_amt(FAUCET_AMOUNT)} {COIN} from the faucet!\n"
+                        f"Next request available in {_FAUCET_PERIOD_STR}.\n\n")
 
 
 # --- Handlers ----------------------------------------------------------------
+# Messages from the same user run serialized (two quick /tip from one
+# sender can't interleave their debits) while different users still run
+# concurrently.
+USER_LOCKS: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+_user_lock_seen: dict[int, int] = {}
+_user_lock_gc_ts = 0
+
+
+@dp.message.middleware()
+async def per_user_lock(handler, event, data):
+    global _user_lock_gc_ts
+    user = getattr(event, "from_user", None)
+    if user is None:
+        return await handler(event, data)
+    _user_lock_seen[user.id] = now()
+    async with USER_LOCKS[user.id]:
+        result = await handler(event, data)
+    # GC locks for users idle longer than the activity window
+    if now() - _user_lock_gc_ts >= ACTIVE_WINDOW:
+        _user_lock_gc_ts = now()
+        cutoff = now() - ACTIVE_WINDOW
+        for uid in [uid for uid, seen in _user_lock_seen.items() if seen < cutoff]:
+            lock = USER_LOCKS.get(uid)
+            if lock is None or not lock.locked():
+                USER_LOCKS.pop(uid, None)
+                _user_lock_seen.pop(uid, None)
+    return result
+
+
 @dp.message(Command("start"))
 async def cmd_start(m: Message):
     if m.chat.type != ChatType.PRIVATE:
         return  # private-only
-    db_upsert_user(m.from_user.id, m.from_user.username or "")
-    addr = get_or_create_deposit_address(m.from_user.id)
+    async with WRITE_LOCK:
+        await db_register_user(m.from_user.id, m.from_user.username or "")
+    addr = await get_or_create_deposit_address(m.from_user.id)
     await m.answer(HELP_TEXT + f"\nYour deposit address: `{addr}`", parse_mode="Markdown")
 
 
@@ -244,8 +486,9 @@ async def cmd_help(m: Message):
 async def cmd_deposit(m: Message):
     if m.chat.type != ChatType.PRIVATE:
         return
-    db_upsert_user(m.from_user.id, m.from_user.username or "")
-    addr = get_or_create_deposit_address(m.from_user.id)
+    async with WRITE_LOCK:
+        await db_register_user(m.from_user.id, m.from_user.username or "")
+    addr = await get_or_create_deposit_address(m.from_user.id)
     await m.answer(f"Your deposit address:\n`{addr}`", parse_mode="Markdown")
 
 
@@ -253,16 +496,18 @@ async def cmd_deposit(m: Message):
 async def cmd_balance(m: Message):
     if m.chat.type != ChatType.PRIVATE:
         return
-    db_upsert_user(m.from_user.id, m.from_user.username or "")
-    u = db_get_user(m.from_user.id)
-    await m.answer(f"Your balance is {fmt_amt(u['balance'])} {COIN}")
+    async with WRITE_LOCK:
+        await db_register_user(m.from_user.id, m.from_user.username or "")
+    u = await db_get_user(m.from_user.id)
+    await m.answer(f"Your balance is {fmt_sat(u['balance_sat'])} {COIN}")
 
 
 @dp.message(Command("withdraw"))
 async def cmd_withdraw(m: Message, command: CommandObject):
     if m.chat.type != ChatType.PRIVATE:
         return
-    db_upsert_user(m.from_user.id, m.from_user.username or "")
+    async with WRITE_LOCK:
+        await db_register_user(m.from_user.id, m.from_user.username or "")
     args = (command.args or "").split()
     if len(args) != 2:
         return await m.answer("Usage: /withdraw amount address")
@@ -273,53 +518,75 @@ async def cmd_withdraw(m: Message, command: CommandObject):
     except Exception:
         return await m.answer("Invalid amount")
     address = args[1]
-    u = db_get_user(m.from_user.id)
-    total_cost = amount
-    if u["balance"] < total_cost:
-        return await m.answer("Insufficient balance")
+    amount_sat = to_sat(amount)
     send_amount = amount - WITHDRAW_FEE
     if send_amount <= 0:
         return await m.answer(f"Amount must be > fee ({WITHDRAW_FEE} {COIN})")
+
+    # debit up front (atomic in SQL) so a concurrent withdraw can't spend
+    # the same funds twice; refund if the node rejects the send
+    async with WRITE_LOCK:
+        async with tx():
+            ok = await db_debit(m.from_user.id, amount_sat)
+    if not ok:
+        return await m.answer("Insufficient balance")
     try:
-        txid = rpc.call("sendtoaddress", [address, float(send_amount)])
+        txid = await rpc.acall("sendtoaddress", [address, float(send_amount)])
     except Exception as e:
+        async with WRITE_LOCK:
+            async with tx():
+                await db_credit(m.from_user.id, amount_sat)
         return await m.answer(f"RPC error: {e}")
-    new_bal = u["balance"] - total_cost
-    db_update_balance(m.from_user.id, new_bal)
-    db_add_transfer("withdraw", m.from_user.id, None, amount, txid)
-    await m.answer(f"Withdrawal submitted. TXID: `{txid}`\nFee: {WITHDRAW_FEE} {COIN}\nNew balance: {fmt_amt(new_bal)} {COIN}",
+    async with WRITE_LOCK:
+        async with tx():
+            await db_add_transfer("withdraw", m.from_user.id, None, amount_sat, txid)
+    u = await db_get_user(m.from_user.id)
+    await m.answer(f"Withdrawal submitted. TXID: `{txid}`\nFee: {WITHDRAW_FEE} {COIN}\nNew balance: {fmt_sat(u['balance_sat'])} {COIN}",
                    parse_mode="Markdown")
 
 
+# Activity only needs ~30s granularity (consumers tolerate the 30-minute
+# window), so chatty groups don't turn every message into a WAL frame.
+ACTIVE_DEBOUNCE = 30
+_active_cache: dict[int, int] = {}
+_active_cache_gc_ts = 0
+
+
 @dp.message(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
 async def mark_active(m: Message):
+    global _active_cache_gc_ts
     # Track activity
     if m.from_user and not m.from_user.is_bot:
-        db_upsert_user(m.from_user.id, m.from_user.username or "")
-        db_set_active(m.from_user.id)
+        ts = now()
+        if ts - _active_cache.get(m.from_user.id, 0) < ACTIVE_DEBOUNCE:
+            return
+        _active_cache[m.from_user.id] = ts
+        # the upsert bumps last_active_ts itself: one statement per message
+        async with WRITE_LOCK:
+            await db_register_user(m.from_user.id, m.from_user.username or "")
+        if ts - _active_cache_gc_ts >= ACTIVE_WINDOW:
+            _active_cache_gc_ts = ts
+            cutoff = ts - ACTIVE_WINDOW
+            for uid in [uid for uid, seen in _active_cache.items() if seen < cutoff]:
+                _active_cache.pop(uid, None)
+
+
+# matches: "@username amount" OR "active amount" OR "amount",
+# validating the amount up front so no try/except Decimal is needed
+_TIP_RE = re.compile(r"^\s*(?:(@\w+)\s+|(active)\s+)?([0-9]+(?:\.[0-9]+)?)\s*$", re.IGNORECASE)
 
 
 def parse_tip_args(s: str):
-    parts = s.strip().split()
-    # matches: "@username amount" OR "active amount" OR "amount"
-    if len(parts) == 1:
-        # amount only
-        try:
-            amt = Decimal(parts[0])
-            return {"mode": "lucky", "amount": amt, "username": None}
-        except Exception:
-            return None
-    elif len(parts) == 2:
-        target, amount_raw = parts
-        try:
-            amt = Decimal(amount_raw)
-        except Exception:
-            return None
-        if target.lower() == "active":
-            return {"mode": "active", "amount": amt, "username": None}
-        if target.startswith("@"):
-            return {"mode": "direct", "amount": amt, "username": target[1:]}
-    return None
+    mt = _TIP_RE.match(s)
+    if not mt:
+        return None
+    target, active, amount_raw = mt.groups()
+    amt = Decimal(amount_raw)
+    if active:
+        return {"mode": "active", "amount": amt, "username": None}
+    if target:
+        return {"mode": "direct", "amount": amt, "username": target[1:]}
+    return {"mode": "lucky", "amount": amt, "username": None}
 
 
 @dp.message(Command("tip"))
@@ -331,63 +598,78 @@ async def cmd_tip(m: Message, command: CommandObject):
     args = parse_tip_args(command.args)
     if not args:
         return await m.answer("Invalid arguments")
-    sender = db_get_user(m.from_user.id)
+    sender = await db_get_user(m.from_user.id)
     if not sender:
         return await m.answer("Please DM me and /start first.")
-    amount = args["amount"]
-    if amount <= 0:
+    amount_sat = to_sat(args["amount"])
+    if amount_sat <= 0:
         return await m.answer("Amount must be > 0")
-    if sender["balance"] < amount:
-        return await m.answer("Insufficient balance")
-    # Determine recipients
+    # Determine recipients (the debit itself enforces sufficient balance)
     recipients = []
     if args["mode"] == "direct":
         # find user by username
-        uname = args["username"].lower()
-        cur = conn.execute("SELECT tg_id, username FROM users")
-        for uid, u_name in cur.fetchall():
-            if u_name and u_name.lower() == uname:
-                recipients = [uid]
-                break
-        if not recipients:
+        uid = await db_find_by_username(args["username"])
+        if uid is None:
             return await m.answer("Target user not found or hasn't /start'ed.")
+        recipients = [uid]
     elif args["mode"] == "active":
         # active users in chat excluding bots and sender
-        chat_member_ids = []
         # We can't enumerate all members via API without extra permissions;
         # approximate using the DB + recent activity.
-        cur = conn.execute("SELECT tg_id FROM users WHERE last_active_ts>=?", (now() - ACTIVE_WINDOW,))
-        chat_member_ids = [row[0] for row in cur.fetchall()]
+        chat_member_ids = await db_active_ids(now() - ACTIVE_WINDOW)
         recipients = [uid for uid in chat_member_ids if uid != m.from_user.id]
         if not recipients:
             return await m.answer("No active users found.")
     else:  # lucky
-        cur = conn.execute("SELECT tg_id FROM users WHERE last_active_ts>=?", (now() - ACTIVE_WINDOW,))
-        candidates = [row[0] for row in cur.fetchall() if row[0] != m.from_user.id]
-        if not candidates:
+        uid = await db_random_active_id(now() - ACTIVE_WINDOW, m.from_user.id)
+        if uid is None:
             return await m.answer("No active users to tip.")
-        recipients = [random.choice(candidates)]
+        recipients = [uid]
     # Execute tip
     if args["mode"] == "active":
-        share = (amount / Decimal(len(recipients))).quantize(Decimal("0.00000001"), rounding=ROUND_DOWN)
-        total = share * Decimal(len(recipients))
-        if sender["balance"] < total:
+        share_sat = amount_sat // len(recipients)
+        if share_sat <= 0:
+            return await m.answer("Amount too small to split")
+        total_sat = share_sat * len(recipients)
+
+        async def _apply_split() -> bool:
+            # one prepared statement per table instead of 2 round trips
+            # per recipient
+            ts = now()
+            async with tx():
+                if not await db_debit(m.from_user.id, total_sat):
+                    return False
+                await conn.executemany("UPDATE users SET balance_sat = balance_sat + ? WHERE tg_id=?",
+                                       [(share_sat, uid) for uid in recipients])
+                await conn.executemany("INSERT INTO transfers(kind, from_tg, to_tg, amount_sat, txid, ts) VALUES('tip',?,?,?,NULL,?)",
+                                       [(m.from_user.id, uid, share_sat, ts) for uid in recipients])
+                # mark sender active
+                await db_set_active(m.from_user.id)
+                return True
+
+        async with WRITE_LOCK:
+            ok = await _apply_split()
+        if not ok:
             return await m.answer("Insufficient balance for split tip")
-        db_update_balance(m.from_user.id, sender["balance"] - total)
-        for uid in recipients:
-            u = db_get_user(uid)
-            db_update_balance(uid, u["balance"] + share)
-            db_add_transfer("tip", m.from_user.id, uid, share, None)
-        await m.answer(f"Tipped {len(recipients)} active users {fmt_amt(share)} {COIN} each.")
+        await m.answer(f"Tipped {len(recipients)} active users {fmt_sat(share_sat)} {COIN} each.")
     else:
         uid = recipients[0]
-        db_update_balance(m.from_user.id, sender["balance"] - amount)
-        u = db_get_user(uid)
-        db_update_balance(uid, u["balance"] + amount)
-        db_add_transfer("tip", m.from_user.id, uid, amount, None)
-        await m.answer(f"Tipped {fmt_amt(amount)} {COIN}.")
-    # mark sender active
-    db_set_active(m.from_user.id)
+
+        async def _apply_direct() -> bool:
+            async with tx():
+                if not await db_debit(m.from_user.id, amount_sat):
+                    return False
+                await db_credit(uid, amount_sat)
+                await db_add_transfer("tip", m.from_user.id, uid, amount_sat, None)
+                # mark sender active
+                await db_set_active(m.from_user.id)
+                return True
+
+        async with WRITE_LOCK:
+            ok = await _apply_direct()
+        if not ok:
+            return await m.answer("Insufficient balance")
+        await m.answer(f"Tipped {fmt_sat(amount_sat)} {COIN}.")
 
 
 @dp.message(Command("active"))
@@ -395,9 +677,8 @@ async def cmd_active(m: Message):
     if m.chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
         return
     # show count of active users in last 30 minutes
-    cur = conn.execute("SELECT username FROM users WHERE last_active_ts>=? ORDER BY last_active_ts DESC",
-                       (now() - ACTIVE_WINDOW,))
-    users = [f"@{row[0]}" for row in cur.fetchall() if row[0]]
+    names = await db_active_usernames(now() - ACTIVE_WINDOW)
+    users = [f"@{name}" for name in names]
     if not users:
         return await m.answer("No active users in the last 30 minutes.")
     await m.answer("Active users (last 30 minutes):\n" + ", ".join(users[:50]))
@@ -408,8 +689,8 @@ async def cmd_faucetinfo(m: Message):
     if m.chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
         return
     try:
-        addr = faucet_address()
-        bal = faucet_balance_confirmed(MIN_CONF)
+        addr = await faucet_address()
+        bal = await faucet_balance_confirmed(MIN_CONF)
     except Exception as e:
         return await m.answer(f"RPC error: {e}")
     await m.answer(f"Faucet deposit address: `{addr}`\nConfirmed balance (approx): {fmt_amt(bal)} {COIN}",
@@ -418,52 +699,199 @@ async def cmd_faucetinfo(m: Message):
 
 @dp.message(Command("faucet"))
 async def cmd_faucet(m: Message):
-    db_upsert_user(m.from_user.id, m.from_user.username or "")
-    u = db_get_user(m.from_user.id)
+    async with WRITE_LOCK:
+        await db_register_user(m.from_user.id, m.from_user.username or "")
+    u = await db_get_user(m.from_user.id)
     if now() - u["last_faucet_ts"] < FAUCET_INTERVAL:
         wait = FAUCET_INTERVAL - (now() - u["last_faucet_ts"])
         mins = wait // 60
         return await m.answer(f"Faucet available in {mins} minutes.")
-    new_bal = u["balance"] + FAUCET_AMOUNT
-    db_update_balance(m.from_user.id, new_bal)
-    db_set_last_faucet(m.from_user.id, now())
-    db_add_transfer("faucet", None, m.from_user.id, FAUCET_AMOUNT, None)
-    await m.answer(f"You received {fmt_amt(FAUCET_AMOUNT)} {COIN} from the faucet!\nNext request available in {FAUCET_INTERVAL//3600 if FAUCET_INTERVAL%3600==0 else FAUCET_INTERVAL//60} {'hours' if FAUCET_INTERVAL>=3600 else 'minutes'}.\n\nYour balance is {fmt_amt(new_bal)} {COIN}")
+    new_bal_sat = u["balance_sat"] + FAUCET_AMOUNT_SAT
+    async with WRITE_LOCK:
+        async with tx():
+            await db_credit(m.from_user.id, FAUCET_AMOUNT_SAT)
+            await db_set_last_faucet(m.from_user.id, now())
+            await db_add_transfer("faucet", None, m.from_user.id, FAUCET_AMOUNT_SAT, None)
+    await m.answer(_FAUCET_REPLY_PREFIX + f"Your balance is {fmt_sat(new_bal_sat)} {COIN}")
 
 
 # --- Scanner -----------------------------------------------------------------
+async def notify(tg_id: int, text: str):
+    async with NOTIFY_SEM:
+        try:
+            await bot.send_message(tg_id, text)
+        except Exception:
+            pass
+
+
+def _tg_from_label(label: str | None) -> int | None:
+    if label and label.startswith(WALLET_LABEL_PREFIX):
+        try:
+            return int(label[len(WALLET_LABEL_PREFIX):])
+        except ValueError:
+            pass
+    return None
+
+
 async def scanner_loop():
     await asyncio.sleep(3)
     log.info("Deposit scanner started")
-    while True:
+
+    async def _depositors():
+        cur = await conn.execute("SELECT tg_id, deposit_address, credited_sat, balance_sat FROM users WHERE deposit_address IS NOT NULL")
+        return await cur.fetchall()
+
+    async def _apply_credits(credits):
+        # batch the whole cycle's credits: one writer lock, one fsync,
+        # one prepared statement per table
+        ts = now()
+        async with tx(immediate=True):
+            await conn.executemany("UPDATE users SET balance_sat = balance_sat + ?, credited_sat=? WHERE tg_id=?",
+                                   [(diff_sat, recv_sat, tg_id)
+                                    for tg_id, _, recv_sat, diff_sat in credits])
+            await conn.executemany("INSERT INTO transfers(kind, from_tg, to_tg, amount_sat, txid, ts) VALUES('deposit',NULL,?,?,NULL,?)",
+                                   [(tg_id, diff_sat, ts) for tg_id, _, _, diff_sat in credits])
+
+    async def _apply_stream_credits(entries, last_block):
+        # entries: (txid, address, tg_id, sat). seen_txs dedups the
+        # re-scan overlap that target_confirmations leaves on purpose;
+        # credited_sat is kept in step so the cumulative fallback stays
+        # consistent.
+        ts = now()
+        credited: dict[int, int] = defaultdict(int)
+        async with tx(immediate=True):
+            for txid, address, tg_id, sat in entries:
+                cur = await conn.execute("INSERT OR IGNORE INTO seen_txs(txid, address) VALUES(?,?)",
+                                         (txid, address))
+                if cur.rowcount == 0:
+                    continue  # already credited on an earlier overlapping scan
+                await conn.execute("UPDATE users SET balance_sat = balance_sat + ?, credited_sat = credited_sat + ? WHERE tg_id=?",
+                                   (sat, sat, tg_id))
+                await conn.execute("INSERT INTO transfers(kind, from_tg, to_tg, amount_sat, txid, ts) VALUES('deposit',NULL,?,?,?,?)",
+                                   (tg_id, sat, txid, ts))
+                credited[tg_id] += sat
+            await db_kv_set("last_block_hash", last_block)
+        return dict(credited)
+
+    # O(new txs) per cycle via listsinceblock once the cursor exists;
+    # cumulative listreceivedbyaddress totals remain as the fallback and
+    # bootstrap path for nodes without it.
+    sinceblock_ok = True
+    list_recv_ok = True
+
+    async def _scan_stream(last_block: str) -> dict[int, int] | None:
+        try:
+            res = await rpc.acall("listsinceblock", [last_block, MIN_CONF])
+        except Exception as e:
+            log.warning("listsinceblock failed, using cumulative totals: %s", e)
+            return None
+        entries = []
+        for t in res.get("transactions", []):
+            if t.get("category") != "receive" or t.get("confirmations", 0) < MIN_CONF:
+                continue
+            tg_id = _tg_from_label(t.get("label") or t.get("account"))
+            if tg_id is None:
+                continue
+            sat = to_sat(Decimal(str(t["amount"])))
+            if sat > 0:
+                entries.append((t["txid"], t.get("address", ""), tg_id, sat))
+        if not entries and res.get("lastblock") == last_block:
+            return {}
+        async with WRITE_LOCK:
+            return await _apply_stream_credits(entries, res["lastblock"])
+
+    async def _init_stream_cursor():
+        # Called right after a cumulative scan: everything confirmed so far
+        # is covered by credited_sat, so seed seen_txs with the confirmed
+        # txs inside the re-scan window instead of crediting them again.
+        nonlocal sinceblock_ok
         try:
-            cur = conn.execute("SELECT tg_id, deposit_address, credited_total, balance FROM users WHERE deposit_address IS NOT NULL")
-            for tg_id, addr, credited_total, bal in cur.fetchall():
-                credited_total = Decimal(credited_total)
+            tip = await rpc.acall("getblockcount")
+            cursor = await rpc.acall("getblockhash", [max(0, tip - MIN_CONF)])
+            res = await rpc.acall("listsinceblock", [cursor, MIN_CONF])
+        except Exception as e:
+            log.warning("listsinceblock unavailable, staying on cumulative totals: %s", e)
+            sinceblock_ok = False
+            return
+        seen = [(t["txid"], t.get("address", "")) for t in res.get("transactions", [])
+                if t.get("category") == "receive" and t.get("confirmations", 0) >= MIN_CONF]
+        async with WRITE_LOCK:
+            async with tx():
+                await conn.executemany("INSERT OR IGNORE INTO seen_txs(txid, address) VALUES(?,?)", seen)
+                await db_kv_set("last_block_hash", res["lastblock"])
+
+    async def _cumulative_cycle():
+        nonlocal list_recv_ok
+        recv_map = None
+        if list_recv_ok:
+            try:
+                rows = await rpc.acall("listreceivedbyaddress", [MIN_CONF, False, False])
+                recv_map = {r["address"]: to_sat(Decimal(str(r["amount"]))) for r in rows}
+            except Exception as e:
+                log.warning("listreceivedbyaddress unavailable, falling back to per-address polling: %s", e)
+                list_recv_ok = False
+        credits = []
+        for tg_id, addr, credited_sat, bal_sat in await _depositors():
+            if recv_map is not None:
+                recv_sat = recv_map.get(addr, 0)
+            else:
                 try:
-                    total_recv = query_received_confirmed(addr, MIN_CONF)
+                    recv_sat = to_sat(await query_received_confirmed(addr, MIN_CONF))
                 except Exception as e:
                     log.warning("RPC getreceivedbyaddress failed: %s", e)
                     continue
-                if total_recv > credited_total:
-                    diff = total_recv - credited_total
-                    # credit to internal balance
-                    new_bal = Decimal(bal) + diff
-                    db_update_balance(tg_id, new_bal)
-                    db_set_credited_total(tg_id, total_recv)
-                    db_add_transfer("deposit", None, tg_id, diff, None)
-                    try:
-                        await bot.send_message(tg_id, f"Deposit confirmed: {fmt_amt(diff)} {COIN}\nNew balance: {fmt_amt(new_bal)} {COIN}")
-                    except Exception:
-                        pass
+            if recv_sat > credited_sat:
+                diff_sat = recv_sat - credited_sat
+                # credit to internal balance
+                credits.append((tg_id, bal_sat + diff_sat, recv_sat, diff_sat))
+        if credits:
+            async with WRITE_LOCK:
+                await _apply_credits(credits)
+            # overlap the Telegram round trips instead of sending serially
+            await asyncio.gather(
+                *(notify(tg_id, f"Deposit confirmed: {fmt_sat(diff_sat)} {COIN}\nNew balance: {fmt_sat(new_bal_sat)} {COIN}")
+                  for tg_id, new_bal_sat, _, diff_sat in credits),
+                return_exceptions=True)
+
+    while True:
+        try:
+            credited = None
+            if sinceblock_ok:
+                last_block = await db_kv_get("last_block_hash")
+                if last_block:
+                    credited = await _scan_stream(last_block)
+                    if credited is None:
+                        sinceblock_ok = False
+            if credited is None:
+                await _cumulative_cycle()
+                if sinceblock_ok:
+                    await _init_stream_cursor()
+            elif credited:
+                qmarks = ",".join("?" for _ in credited)
+                cur = await conn.execute(f"SELECT tg_id, balance_sat FROM users WHERE tg_id IN ({qmarks})",
+                                         list(credited))
+                bal = {row["tg_id"]: row["balance_sat"] for row in await cur.fetchall()}
+                await asyncio.gather(
+                    *(notify(tg_id, f"Deposit confirmed: {fmt_sat(sat)} {COIN}\nNew balance: {fmt_sat(bal.get(tg_id, 0))} {COIN}")
+                      for tg_id, sat in credited.items()),
+                    return_exceptions=True)
         except Exception as e:
             log.error("Scanner error: %s", e)
         await asyncio.sleep(SCAN_INTERVAL)
 
 
 async def main():
-    asyncio.create_task(scanner_loop())
-    await dp.start_polling(bot)
+    global conn
+    conn = await aiosqlite.connect(DB_PATH)
+    # name-based column access in C, without building a dict per row
+    conn.row_factory = sqlite3.Row
+    await init_db()
+    try:
+        asyncio.create_task(scanner_loop())
+        await dp.start_polling(bot)
+    finally:
+        await rpc.client.aclose()
+        await conn.close()
 
 
 if __name__ == "__main__":